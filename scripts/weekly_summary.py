@@ -6,42 +6,86 @@
 #  service_identity
 
 import csv
+import io
 import json
+import re
+import sys
 from datetime import date
-from datetime import datetime
 from datetime import timedelta
 from functools import partial
 from twisted.python import log
 from twisted.internet import defer
 from twisted.internet import reactor
+from twisted.internet.threads import deferToThread
 from twisted.web.client import Agent
+from twisted.web.client import ContentDecoderAgent
+from twisted.web.client import GzipDecoder
 from twisted.web.client import readBody
+from twisted.web.error import Error
 from twisted.web.http_headers import Headers
 
 TRAC_BUILDBOT_URL = 'http://trac.buildbot.net'
-TRAC_BUILDBOT_TICKET_URL = TRAC_BUILDBOT_URL + '/ticket/%(ticket)s'
+TRAC_BUILDBOT_TICKET_URL = TRAC_BUILDBOT_URL + '/ticket/'
+# Columns requested from the Trac query, in the order they are returned.
+TRAC_TICKET_FIELDS = ('id', 'summary', 'type', 'status')
 GITHUB_API_URL = 'https://api.github.com'
+# The search API won't return more results than this, however many pages the
+# Link header claims there are; asking for pages past it gets a 422.
+GITHUB_SEARCH_MAX_RESULTS = 1000
+GITHUB_SEARCH_PER_PAGE = 100
 HTTP_HEADERS = Headers({'User-Agent': ['buildbot.net weekly summary']})
+# Row of the ticket summary that each Trac ticket type is counted in. Anything
+# else is counted as 'Other'.
+TRAC_TICKET_TYPES = {
+    'enhancement': 'Enhancements',
+    'defect': 'Defects',
+    'task': 'Tasks',
+    'regression': 'Regressions',
+    'undecided': 'Undecideds',
+}
+
+def get_agent():
+    """
+    Get an agent that asks for gzip-compressed responses and transparently
+    decompresses them.
+    """
+    return ContentDecoderAgent(Agent(reactor), [('gzip', GzipDecoder)])
 
 def get_body(what, f):
     def cb(resp):
         d = readBody(resp)
-        d.addCallback(partial(f, what))
+        # Parse the body in a worker thread so a large response doesn't hold
+        # up the reactor while the other requests are still being read.
+        d.addCallback(partial(deferToThread, f, what))
         return d
     return cb
 
+# Left-justify every cell except the first column. Return None for the first
+# column to have it skipped.
+bug_list_formatter = lambda c, size, header: c.ljust(size) if header else None
+
+def get_col_widths(cols, row_labels, cells):
+    """
+    Get the width needed to fit each column of the already stringified cells.
+    The final value is for the row labels.
+    """
+    # At a minimum, need to be able to fit the column headers.
+    col_widths = [len(c) for c in cols]
+    if cells:
+        # Transpose the rows into columns so that map and max do the looping
+        # over each column's cells.
+        col_widths = [max(width, max(map(len, column)))
+            for width, column in zip(col_widths, zip(*cells))]
+    # The row names go at the end to keep enumerate calls simple.
+    label_width = max(map(len, row_labels)) if row_labels else 0
+    return col_widths + [label_width]
+
 def tablify_dict(d, show_header=True, field_formatter=None, row_order=None, col_order=None, col_padding=1):
-    # Allow custom formatting of the fields. Default to right-justifying
-    # everything but the "''" (i.e. first) column.
-    if field_formatter is None:
-        format_cell = lambda c, size, header: c.rjust(size) if header else c.ljust(size)
-    else:
-        format_cell = field_formatter
-    # Allow the custom formatter to return None for a field. Add a function
-    # that will iterate over each row to filter out the None cells before
-    # joining. 
-    skip_nones = lambda c: c is not None
-    if row_order is None:
+    # A list of rows is also accepted, in which case the row names are the
+    # indices.
+    if row_order is None and isinstance(d, list):
+        rows = range(len(d))
+    elif row_order is None:
         rows = sorted(d.keys())
     else:
         rows = row_order
@@ -51,29 +95,45 @@ def tablify_dict(d, show_header=True, field_formatter=None, row_order=None, col_
     else:
         cols = col_order
 
-    # At a minimum, need to be able to fit the column headers. The final value
-    # is for the row names. Putting it at the end to keep subsequent enumerate
-    # calls simple.
-    col_widths = [len(c) for c in cols] + [0]
-    for r in rows:
-        col_widths[-1] = max(col_widths[-1], len(str(r)))
-        for i, c in enumerate(cols):
-            col_widths[i] = max(col_widths[i], len(str(d[r][c])))
+    # Stringify every cell once up front; both the width calculation and the
+    # row output below work off these.
+    row_labels = [str(r) for r in rows]
+    cells = [[str(v[c]) for c in cols] for v in [d[r] for r in rows]]
+
+    col_widths = get_col_widths(cols, row_labels, cells)
     padding = ' ' * col_padding
+
+    # Default to right-justifying everything but the "''" (i.e. first)
+    # column. Every cell is kept, so build one format string for the whole
+    # row and lay out each row (the header included) with a single call.
+    if field_formatter is None:
+        row_format = padding.join(['{:<%d}' % col_widths[-1]] +
+            ['{:>%d}' % w for w in col_widths[:-1]])
+        table = [row_format.format('', *cols)] if show_header else []
+        table.extend(row_format.format(label, *row)
+            for label, row in zip(row_labels, cells))
+        return '\n'.join(table)
+
+    # Allow custom formatting of the fields. The custom formatter may return
+    # None for a field; those cells get filtered out of each row before
+    # joining.
+    format_cell = field_formatter
     # The first row of the table is the header.
     if show_header:
         th_row = ([format_cell('', col_widths[-1], '')] + 
             [format_cell(c, col_widths[i], c) for i, c in enumerate(cols)])
-        th = padding.join(filter(skip_nones, th_row))
-        table = [th]
+        table = [padding.join([c for c in th_row if c is not None])]
     else:
         table = []
-    for r in rows:
-        tr = [format_cell(r, col_widths[-1], '')]
+    # Pull the loop invariants out of the per-row work.
+    row_size = len(cols) + 1
+    label_width = col_widths[-1]
+    for label, row in zip(row_labels, cells):
+        tr = [None] * row_size
+        tr[0] = format_cell(label, label_width, '')
         for i, c in enumerate(cols):
-            value = d[r][c]
-            tr.append(format_cell(str(value), col_widths[i], c))
-        table.append(padding.join(filter(skip_nones, tr)))
+            tr[i + 1] = format_cell(row[i], col_widths[i], c)
+        table.append(padding.join([c for c in tr if c is not None]))
     return '\n'.join(table)
 
 def get_trac_tickets(start_day, end_day):
@@ -81,12 +141,14 @@ def get_trac_tickets(start_day, end_day):
     Get the last week's worth of tickets, where week ends through yesterday.
     """
     def format_trac_tickets(what, body):
-        tickets = csv.reader(body.splitlines(), delimiter='\t')
-        # Trac returns a tab-delimited file with the header. Skip it.
+        # Stream the body straight into the csv reader rather than building a
+        # list of lines first.
+        tickets = csv.reader(io.BytesIO(body), delimiter='\t')
+        # Trac returns a tab-delimited file with the header. Skip it; it can
+        # start with a UTF-8 BOM, so don't rely on it for the field names.
         next(tickets)
-        # Returned format is id, summary, type.
-        summary = [{'id': t[0], 'summary': t[1], 'type': t[2],
-            'url': TRAC_BUILDBOT_TICKET_URL % {'ticket': t[0]}}
+        summary = [dict(zip(TRAC_TICKET_FIELDS, t),
+            url=TRAC_BUILDBOT_TICKET_URL + t[0])
             for t in tickets]
         return (what, summary)
 
@@ -97,23 +159,23 @@ def get_trac_tickets(start_day, end_day):
             'Defects': each_type.copy(), 'Tasks': each_type.copy(),
             'Regressions': each_type.copy(), 'Undecideds': each_type.copy(),
             'Other': each_type.copy(), 'Total': each_type.copy()}
-        opened = {}
-        closed = {}
+        opened = []
+        closed = []
         for success, value in results:
             if not success:
                 continue
             what, tickets = value
             for t in tickets:
-                Type = t['type'].capitalize() + 's'
-                if Type in ticket_summary:
-                    ticket_summary[Type][what] += 1
-                else:
-                    ticket_summary['Other'][what] += 1
-                ticket_summary['Total'][what] += 1
+                Type = TRAC_TICKET_TYPES.get(t['type'].lower(), 'Other')
+                ticket_summary[Type][what] += 1
                 if what == 'Opened':
-                    opened[len(opened)] = t
+                    opened.append(t)
                 elif what == 'Closed':
-                    closed[len(closed)] = t
+                    closed.append(t)
+        # The total is just the sum over every ticket type.
+        for what in ticket_summary['Total']:
+            ticket_summary['Total'][what] = sum(counts[what]
+                for Type, counts in ticket_summary.items() if Type != 'Total')
         # Convert ticket summary to a table to start the weekly summary.
         row_order = ['Enhancements', 'Defects', 'Regressions', 'Tasks',
             'Undecideds', 'Other', 'Total']
@@ -124,9 +186,6 @@ def get_trac_tickets(start_day, end_day):
 
         # Also include a list of every new/reopened and closed tickets.
         col_order = ['id', 'type', 'summary', 'url']
-        # Left-justify every cell except the first column. Return None for the
-        # first column to have it skipped.
-        bug_list_formatter = lambda c, size, header: c.ljust(size) if header else None
         opened_table = tablify_dict(opened, show_header=False,
             col_order=col_order, col_padding=col_padding,
             field_formatter=bug_list_formatter)
@@ -140,27 +199,26 @@ def get_trac_tickets(start_day, end_day):
         trac_summary = [ticket_overview, opened_overview, closed_overview]
         return ('trac', '\n\n'.join(trac_summary))
 
-    trac_query_url = ('%(trac_url)s/query?%(status)s&format=tab'
+    # Fill in everything but the status up front; that is all that differs
+    # between the two queries.
+    trac_query_url = ('%(trac_url)s/query?%%(status)s&format=tab'
         '&changetime=%(start)s..%(end)s'
-        '&col=id&col=summary&col=type&col=status&order=id')
-    url_options = {
+        '&col=id&col=summary&col=type&col=status&order=id') % {
         'trac_url': TRAC_BUILDBOT_URL,
         'start': start_day,
         'end': end_day,
     }
 
-    agent = Agent(reactor)
+    agent = get_agent()
     fetches = []
     # Need to make two queries: one to get the new/reopened tickets and a
     # second to get the closed tickets.
-    url_options['status'] = 'status=new&status=reopened'
-    new_url = trac_query_url % (url_options)
+    new_url = trac_query_url % {'status': 'status=new&status=reopened'}
     d = agent.request('GET', new_url, HTTP_HEADERS)
     d.addCallback(get_body('Opened', format_trac_tickets))
     fetches.append(d)
 
-    url_options['status'] = 'status=closed'
-    closed_url = trac_query_url % (url_options)
+    closed_url = trac_query_url % {'status': 'status=closed'}
     d = agent.request('GET', closed_url, HTTP_HEADERS)
     d.addCallback(get_body('Closed', format_trac_tickets))
     fetches.append(d)
@@ -169,57 +227,133 @@ def get_trac_tickets(start_day, end_day):
     dl.addCallback(summarize_trac_tickets)
     return dl
 
+def parse_github_date(timestamp):
+    """
+    Get the date of a GitHub timestamp.
+    """
+    # Github returns ISO8601 in UTC (e.g. 2014-06-01T12:34:56Z), and only the
+    # day matters here, so slice it out instead of going through strptime.
+    return date(int(timestamp[0:4]), int(timestamp[5:7]), int(timestamp[8:10]))
+
+def check_github_response(resp):
+    """
+    Fail on anything but a 200 from GitHub (e.g. a 403 when rate limited)
+    rather than trying to read pull requests out of the error body.
+    """
+    if resp.code != 200:
+        raise Error(resp.code, resp.phrase)
+    return resp
+
+def get_last_page(headers):
+    """
+    Get the number of the last page of a paginated GitHub response.
+    """
+    # The Link header looks like:
+    #   <https://api.github.com/...&page=2>; rel="next",
+    #   <https://api.github.com/...&page=5>; rel="last"
+    # and is missing altogether if everything fit on one page.
+    for link in headers.getRawHeaders('link', []):
+        for part in link.split(','):
+            if 'rel="last"' in part:
+                m = re.search(r'[?&]page=(\d+)', part)
+                if m:
+                    return int(m.group(1))
+    return 1
+
 def get_github_prs(start_day, end_day):
     """
     Get the last week's worth of tickets, where week ends through yesterday.
     """
-    def summarize_github_prs(what, body_json):
-        # I don't know a good way to parse the time zone. Github returns
-        # ISO8601 in UTC.
-        gh_time_format = '%Y-%m-%dT%H:%M:%SZ'
-        opened_prs = {}
-        closed_prs = {}
-        body = json.loads(body_json)
+    # Only these fields of a pull request end up in the summary, and the
+    # remaining ones are needed to pick which table it goes in.
+    col_order = ['number', 'title', 'html_url']
+    pr_fields = col_order + ['state', 'created_at', 'closed_at']
+
+    def parse_github_page(page, body_json):
+        # The search API wraps the matching pull requests in 'items'. Each of
+        # those carries dozens of fields, so slim them down to the few that
+        # are used while still in the worker thread; that way only one page
+        # of full pull requests is held at a time.
+        return [dict((f, pr[f]) for f in pr_fields)
+            for pr in json.loads(body_json)['items']]
+
+    def summarize_github_prs(what, body):
+        opened_prs = []
+        closed_prs = []
         categories = [
             ('Opened', 'open', 'created_at', opened_prs),
             ('Completed', 'closed', 'closed_at', closed_prs),
         ]
+        # Each state only falls into one category, so look the category up
+        # rather than checking the pull request against every one of them.
+        by_state = dict((state, (when, pr_list))
+            for _, state, when, pr_list in categories)
         for pr in body:
-            for group in categories:
-                _, state, when, pr_dict = group
-                # Have to check if the when field is not None. The state is
-                # 'closed' for merged and unmerged pull requests. The merged
-                # tuple is first, so any pull request that is closed and has a
-                # merged_at date will be added there before checking the
-                # closed_at date.
-                if pr['state'] == state and pr[when] is not None:
-                    happened = datetime.strptime(pr[when], gh_time_format)
-                    # If this pull request was created outside of the summary
-                    # period, skip it.
-                    if happened.date() < start_day or happened.date() > end_day:
-                        continue
-                    pr_dict[len(pr_dict)] = pr
+            # The state is 'closed' for merged and unmerged pull requests.
+            if pr['state'] not in by_state:
+                continue
+            when, pr_list = by_state[pr['state']]
+            # Have to check if the when field is not None.
+            if pr[when] is None:
+                continue
+            happened = parse_github_date(pr[when])
+            # If this pull request happened outside of the summary period,
+            # skip it.
+            if happened < start_day or happened > end_day:
+                continue
+            pr_list.append(pr)
 
         overviews = []
-        bug_list_formatter = lambda c, size, header: c.ljust(size) if header else None
         for group in categories:
-            what, _, _, pr_dict = group
+            what, _, _, pr_list = group
             title = what + ' Pull Requests'
             title_h2 = '-'*len(title)
-            table = tablify_dict(pr_dict, show_header=False,
-                row_order=sorted(pr_dict.keys(), lambda a,b: cmp(b, a)),
-                col_order=['number', 'title', 'html_url'],
+            table = tablify_dict(pr_list, show_header=False,
+                row_order=range(len(pr_list) - 1, -1, -1),
+                col_order=col_order,
                 col_padding=2, field_formatter=bug_list_formatter)
             overviews.append('\n'.join([title, title_h2, table]))
         return ('github', '\n\n'.join(overviews))
 
 
-    gh_api_url = ('%(api_url)s/repos/buildbot/buildbot/pulls?state=all')
-    url_options = {'api_url': GITHUB_API_URL}
+    # Let GitHub narrow the pull requests down rather than listing every one
+    # ever made. Anything opened or closed during the summary period has been
+    # updated since it started. Newest first, like the pulls listing.
+    gh_api_url = ('%(api_url)s/search/issues'
+        '?q=repo:buildbot/buildbot+is:pr+updated:%%3E%%3D%(start)s'
+        '&sort=created&order=desc&per_page=%(per_page)d')
+    url_options = {
+        'api_url': GITHUB_API_URL,
+        'start': start_day,
+        'per_page': GITHUB_SEARCH_PER_PAGE,
+    }
     url = gh_api_url % (url_options)
-    agent = Agent(reactor)
+    agent = get_agent()
+
+    def fetch_remaining_pages(resp):
+        # The first page is already in hand. It names the last page, so
+        # request all of the others at once rather than one after another.
+        last_page = min(get_last_page(resp.headers),
+            GITHUB_SEARCH_MAX_RESULTS // GITHUB_SEARCH_PER_PAGE)
+        fetches = [get_body(1, parse_github_page)(resp)]
+        for page in range(2, last_page + 1):
+            page_url = '%s&page=%d' % (url, page)
+            d = agent.request('GET', page_url, HTTP_HEADERS)
+            d.addCallback(check_github_response)
+            d.addCallback(get_body(page, parse_github_page))
+            fetches.append(d)
+        # Any missing page would leave pull requests out of the summary, so
+        # fail the whole thing rather than report on part of them.
+        dl = defer.DeferredList(fetches, fireOnOneErrback=True,
+            consumeErrors=True)
+        # Stitch the pages back together in order.
+        dl.addCallback(lambda results: [pr for _, prs in results for pr in prs])
+        return dl
+
     d = agent.request('GET', url, HTTP_HEADERS)
-    d.addCallback(get_body('Github', summarize_github_prs))
+    d.addCallback(check_github_response)
+    d.addCallback(fetch_remaining_pages)
+    d.addCallback(partial(deferToThread, summarize_github_prs, 'Github'))
     return d
 
 
@@ -238,7 +372,8 @@ def summary(results):
             continue
         part, msg = value
         message_parts[part] = msg
-    print message % message_parts
+    # Write the whole report out in one go.
+    sys.stdout.write(message % message_parts + '\n')
 
 def main():
     end_day = date.today() - timedelta(1)